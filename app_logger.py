@@ -1,6 +1,6 @@
 import logging
+from functools import lru_cache
 from os import getenv
-from typing import Union
 
 APP_NAME = "postgoose"
 
@@ -20,11 +20,19 @@ DEFAULT_LOG_LEVEL = logging.INFO
 
 IS_LAMBDA = True if getenv("AWS_LAMBDA_FUNCTION_NAME") else False
 
+_initialized = False
+
 
 def initialize_logger(level: int = DEFAULT_LOG_LEVEL):
     """
     initialize_logger
     """
+    global _initialized
+    if _initialized:
+        # Configuring again would only redo the same handler setup
+        return
+    _initialized = True
+
     if len(logging.getLogger().handlers) > 0:
         # This ensures that a pre-existing root logger
         # will be formatted using our formatter
@@ -52,6 +60,7 @@ def initialize_logger(level: int = DEFAULT_LOG_LEVEL):
     logger.setLevel(level)
 
 
+@lru_cache(maxsize=None)
 def get_app_logger(name: str = None):
     """
     get_app_logger
@@ -1,119 +1,290 @@
 #!/usr/bin/env python
 
+import atexit
+import csv
+import io
 import os
+import re
+import string
+import threading
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, replace
 from hashlib import sha256
 from pathlib import PosixPath
-from typing import List, Set, Iterable, Optional, T, Tuple
-from psycopg2 import connect, OperationalError, IntegrityError, sql
+from typing import Dict, List, Optional, Tuple
+from psycopg2 import (
+    connect, errorcodes, InterfaceError, OperationalError, IntegrityError, sql
+)
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 from app_logger import get_app_logger
 from goose_version import __version__
-from goose_utils import print_args, print_up_down, DBParams, Migration
-    
+from goose_utils import print_args, print_up_down, DBParams, DigestCache, Migration
 
 Schema = str
 
 # Defaults
 migrations_table = "goose_migrations"
 
+MIGRATION_FILE_PATTERN = re.compile(r"^([1-9][0-9]*)_(up|down)\.sql$")
+
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# Below this many rows a plain INSERT beats the fixed cost of COPY
+copy_threshold = 16
+
+# Below this many digests or files a thread pool costs more than it saves
+min_parallel_digests = 4
+min_parallel_reads = 4
+
+# Bookkeeping statements, each runs once per batch of migrations
+INSERT_MIGRATIONS = sql.SQL("""
+    INSERT INTO {table} (migration_id, up_digest, up, down_digest, down)
+    VALUES %s;
+""")
+COPY_MIGRATIONS = sql.SQL("""
+    COPY {table} (migration_id, up_digest, up, down_digest, down)
+    FROM STDIN WITH CSV;
+""")
+DELETE_MIGRATIONS = sql.SQL("""
+    DELETE FROM {table} WHERE migration_id = ANY(%s);
+""")
+
+# Connection pools of run_migrations(use_pool=True), by connection parameters
+_pools: Dict[DBParams, ThreadedConnectionPool] = {}
+_pools_lock = threading.Lock()
+
 logger = get_app_logger()
 
 
-def get_migration_id(file_name: str) -> int:
-    try:
-        return int(file_name.split('_')[0])
-    except ValueError:
-        raise RuntimeError(
-            f'ERROR: File "{file_name}" is not of pattern '
-            '"(id)_up.sql" or "(id)_down.sql"')
+def get_migration_files(dir: PosixPath) -> Dict[str, os.DirEntry]:
+    with os.scandir(dir) as entries:
+        migration_files = {
+            entry.name: entry
+            for entry in entries
+            if entry.name.endswith((".sql", ".SQL")) and entry.is_file()
+        }
 
+    # DirEntry keeps the result of its first stat. Taking it before the
+    # files are read keys the digest cache on a stat no newer than the
+    # content that gets hashed
+    for entry in migration_files.values():
+        entry.stat()
 
-def get_max_migration_id(filenames: List[str]) -> int:
-    return max(get_migration_id(file_name) for file_name in filenames)
+    return migration_files
 
 
-def get_migration_files_filtered(dir: PosixPath) -> List[str]:
-    return [file for file in os.listdir(dir.as_posix()) if file.lower().endswith(".sql")]
+def read_migration_file(path: str) -> bytes:
+    # Unbuffered, the file is read whole in a single call sized from fstat
+    with open(path, "rb", buffering=0) as fp:
+        data = fp.read()
 
+    # Same newline translation as reading the file in text mode,
+    # so the bytes hash to the same digest as the decoded text
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
 
-def assert_all_migrations_present(dir: PosixPath) -> None:
-    filenames: List[str] = get_migration_files_filtered(dir)
-    if not filenames:
-        logger.warning(f"Migrations folder {dir} is empty. Exiting gracefully!")
-        return
+    return data
 
-    max_migration_id = get_max_migration_id(filenames)
 
-    for migration_id in range(1, max_migration_id + 1):
-        # todo - assertions can be ignored...?
-        assert f"{migration_id}_up.sql" in filenames, f"Migration {migration_id} missing ups"
-        assert f"{migration_id}_down.sql" in filenames, f"Migration {migration_id} missing downs"
+def read_migration_files(entries: List[os.DirEntry]) -> List[bytes]:
+    paths = [entry.path for entry in entries]
 
-    extra_files: Set[str] = (
-        set(filenames)
-        - {f"{m_id}_up.sql" for m_id in range(1, max_migration_id + 1)}
-        - {f"{m_id}_down.sql" for m_id in range(1, max_migration_id + 1)}
-    )
+    if len(paths) < min_parallel_reads:
+        return [read_migration_file(path) for path in paths]
 
-    if extra_files:
-        logger.error(f'Extra files not of pattern "<id>_up.sql" or "<id>_down.sql": ')
-        print(*extra_files, sep="\n")
-        exit(3)
+    # File reads release the GIL, so several can be in flight at once
+    with ThreadPoolExecutor(max_workers=min(32, len(paths))) as executor:
+        return list(executor.map(read_migration_file, paths))
 
 
-def parse_migrations(dir: PosixPath) -> List[Migration]:
-    filenames: List[str] = get_migration_files_filtered(dir)
-    max_migration_id: int = get_max_migration_id(filenames)
+def check_migration_files(migration_files: Dict[str, os.DirEntry]) -> int:
+    """
+    Checks that every id up to the highest one has an up and a down file
+    and returns that id, so the file names are only parsed once
+    """
+    if not migration_files:
+        return 0
+
+    # Presence of each id's up and down file, indexed by migration id
+    ups = bytearray(len(migration_files) + 1)
+    downs = bytearray(len(migration_files) + 1)
+    max_migration_id = 0
+    extra_files: List[str] = []
+
+    for file_name in migration_files:
+        match = MIGRATION_FILE_PATTERN.match(file_name)
+        if not match:
+            extra_files.append(file_name)
+            continue
+
+        migration_id = int(match.group(1))
+        max_migration_id = max(max_migration_id, migration_id)
+
+        # An id beyond the number of files always leaves a gap below it,
+        # which is reported before the scan below could reach it
+        if migration_id < len(ups):
+            (ups if match.group(2) == "up" else downs)[migration_id] = 1
+
+    # Lowest ids without an up or a down file, -1 when there is none
+    missing_up = ups.find(0, 1, max_migration_id + 1)
+    missing_down = downs.find(0, 1, max_migration_id + 1)
+    missing = [i for i in (missing_up, missing_down) if i != -1]
+
+    # Only the lowest incomplete id is reported, as missing its up
+    # when both of its files are missing
+    if missing:
+        first_missing = min(missing)
+        kind = "ups" if first_missing == missing_up else "downs"
+        raise AssertionError(f"Migration {first_missing} missing {kind}")
 
-    migrations: List[Migration] = [
-        parse_migration(dir, migration_id) for migration_id in range(1, max_migration_id + 1)
-    ]
+    if extra_files:
+        logger.error(
+            'Extra files not of pattern "<id>_up.sql" or "<id>_down.sql":\n'
+            + "\n".join(sorted(extra_files))
+        )
+        exit(3)
 
-    return migrations
+    return max_migration_id
 
 
-def parse_migration(dir: PosixPath, migration_id: int) -> Migration:
-    up_file: PosixPath = dir.joinpath(f"{migration_id}_up.sql")
-    down_file: PosixPath = dir.joinpath(f"{migration_id}_down.sql")
+def parse_migrations(
+    migration_files: Dict[str, os.DirEntry],
+    max_migration_id: int,
+    digest_cache: Optional[DigestCache]
+) -> List[Migration]:
+    # Built in id order, callers rely on the result being sorted
+    migration_ids = range(1, max_migration_id + 1)
 
-    with open(up_file) as up_fp, open(down_file) as down_fp:
+    up_files = [migration_files[f"{migration_id}_up.sql"] for migration_id in migration_ids]
+    up_data = read_migration_files(up_files)
+    ups = [data.decode("utf-8") for data in up_data]
 
-        up = up_fp.read()
-        up_digest = digest(up)
-        down = down_fp.read()
-        down_digest = digest(down)
+    # Without a cache, digests are only computed once they are needed,
+    # see get_diff and complete_migrations
+    if digest_cache is None:
+        up_digests = [None] * len(ups)
+    else:
+        up_digests = cached_digests(up_files, up_data, digest_cache)
 
-        migration = Migration(
+    # Downs are only read for migrations that get applied,
+    # see complete_migrations
+    return [
+        Migration(
             migration_id=migration_id,
             up_digest=up_digest,
             up=up,
-            down_digest=down_digest,
-            down=down,
+            down_digest=None,
+            down=None,
         )
-        return migration
+        for migration_id, up, up_digest in zip(migration_ids, ups, up_digests)
+    ]
 
 
-def acquire_mutex(cursor) -> None:
-    try:
-        cursor.execute(
-            f"""
-        /* Ideal lock timeout? */
-        SET lock_timeout TO '2s';    
-
-        LOCK TABLE {migrations_table} IN EXCLUSIVE MODE;
+def complete_migrations(
+    migrations: List[Migration],
+    migration_files: Dict[str, os.DirEntry],
+    digest_cache: Optional[DigestCache]
+) -> List[Migration]:
+    """
+    Reads the downs and fills in the digests of migrations about to be applied
     """
+    down_files = [
+        migration_files[f"{migration.migration_id}_down.sql"] for migration in migrations
+    ]
+    down_data = read_migration_files(down_files)
+    downs = [data.decode("utf-8") for data in down_data]
+
+    if digest_cache is None:
+        digests = digest_all(
+            [migration.up.encode("utf-8") for migration in migrations] + down_data
         )
-    except OperationalError as e:
-        raise RuntimeError("Migrations already in progress")
+        up_digests = digests[:len(migrations)]
+        down_digests = digests[len(migrations):]
+    else:
+        up_digests = [migration.up_digest for migration in migrations]
+
+        # Parsed without the cache when the diff compared text
+        if None in up_digests:
+            up_files = [
+                migration_files[f"{migration.migration_id}_up.sql"]
+                for migration in migrations
+            ]
+            up_digests = cached_digests(
+                up_files,
+                [migration.up.encode("utf-8") for migration in migrations],
+                digest_cache
+            )
+        down_digests = cached_digests(down_files, down_data, digest_cache)
 
+    return [
+        replace(migration, up_digest=up_digest, down_digest=down_digest, down=down)
+        for migration, up_digest, down, down_digest
+        in zip(migrations, up_digests, downs, down_digests)
+    ]
+
+
+def cached_digests(
+    entries: List[os.DirEntry],
+    contents: List[bytes],
+    digest_cache: DigestCache
+) -> List[str]:
+    digests = [digest_cache.get(entry) for entry in entries]
+    missing = [i for i, cached in enumerate(digests) if cached is None]
+
+    for i, computed in zip(missing, digest_all([contents[i] for i in missing])):
+        digests[i] = computed
+        digest_cache.put(entries[i], computed)
+
+    return digests
+
+
+def set_up_session(
+    cursor,
+    schema: str,
+    role: Optional[str],
+    table: sql.Identifier
+) -> None:
+    # Sent as a single batch to save a round trip per statement
+    search_path = sql.SQL(", ").join(
+        sql.Identifier(fold_identifier(name)) for name in schema.split(",")
+    )
+    statements: List[sql.Composable] = [
+        sql.SQL("set search_path to {}").format(search_path)
+    ]
+
+    if role is not None:
+        statements.append(
+            sql.SQL("set role {}").format(sql.Identifier(fold_identifier(role)))
+        )
 
-def set_search_path(cursor, schema: str) -> None:
-    cursor.execute(sql.SQL("set search_path to {}".format(schema)))
+    statements.append(CINE_migrations_table_sql(table))
+    statements.append(acquire_mutex_sql(table))
 
+    try:
+        cursor.execute(sql.SQL(";\n").join(statements))
+    except IntegrityError as e:
+        # A concurrent run created the migrations table first
+        raise RuntimeError("Migrations already in process") from e
+    except OperationalError as e:
+        # Only the lock timeout means another run, anything else such
+        # as a lost connection is raised as it is
+        if e.pgcode != errorcodes.LOCK_NOT_AVAILABLE:
+            raise
+        raise RuntimeError("Migrations already in progress") from e
 
-def set_role(cursor, role: str) -> None:
-    cursor.execute(sql.SQL("set role {}".format(role)))
+
+def acquire_mutex_sql(table: sql.Identifier) -> sql.Composed:
+    return sql.SQL(
+        """
+        /* Ideal lock timeout? */
+        SET lock_timeout TO '2s';
+
+        LOCK TABLE {table} IN EXCLUSIVE MODE
+    """
+    ).format(table=table)
 
 
 def main() -> None:
@@ -134,6 +305,13 @@ def main() -> None:
         help="Set False to compare with saved digest "
         "instead of re-computing digest. Default is True",
     )
+    parser.add_argument(
+        "--no_cache",
+        action="store_false",
+        dest="use_digest_cache",
+        help="Set to re-compute digests of unchanged files "
+        "instead of using the ones cached by earlier runs",
+    )
     parser.add_argument(
         "-m", 
         "--migrations_table_name",
@@ -184,7 +362,8 @@ def main() -> None:
         args.migrations_table_name,
         args.auto_apply_down,
         args.verbose,
-        args.strict_digest_check
+        args.strict_digest_check,
+        args.use_digest_cache
     )
 
 
@@ -196,92 +375,187 @@ def run_migrations(
     migrations_table_name=None,
     auto_apply_down=False,
     verbose=False,
-    strict_digest_check=True
+    strict_digest_check=True,
+    use_digest_cache=True,
+    use_pool=False
 ):
     if verbose:
         logger.setLevel('DEBUG')
 
     migrations_directory = _get_migrations_directory(migrations_directory)
+    table = table_identifier(migrations_table_name or migrations_table)
 
-    assert_all_migrations_present(migrations_directory)
+    migration_files: Dict[str, os.DirEntry] = get_migration_files(migrations_directory)
 
-    conn = connect(**vars(db_params))
+    max_migration_id = check_migration_files(migration_files)
 
-    with conn:
-        cursor = conn.cursor()
+    if not max_migration_id:
+        logger.warning(
+            f"Migrations folder {migrations_directory} is empty. Exiting gracefully!"
+        )
+        return
 
-        set_search_path(cursor, schema)
+    if use_digest_cache:
+        digest_cache = DigestCache.for_directory(migrations_directory)
+        digest_cache.prune(migration_files)
+    else:
+        digest_cache = None
+
+    # Parsed before connecting, so reading the files does not add to
+    # the time the migrations table stays locked
+    # The strict check compares text, so it only needs the digests of
+    # the migrations it applies, see complete_migrations
+    migrations_from_filesystem: List[Migration] = parse_migrations(
+        migration_files,
+        max_migration_id,
+        None if strict_digest_check else digest_cache
+    )
 
-        if role is not None:
-            set_role(cursor, role)
+    # Pooling is opt in for programs calling run_migrations repeatedly,
+    # a pooled connection is not checked before use, so it fails the
+    # run if the server dropped it in the meantime
+    if use_pool:
+        pool = get_connection_pool(db_params)
+        conn = pool.getconn()
+    else:
+        conn = connect(**asdict(db_params))
 
-        if migrations_table_name is not None:
-            global migrations_table
-            migrations_table = migrations_table_name
+    try:
+        with conn:
+            cursor = conn.cursor()
 
-        CINE_migrations_table(conn.cursor())
+            # Also locks the migrations table, so the diff below can not be
+            # invalidated by a concurrent run before it is applied
+            set_up_session(cursor, schema, role, table)
 
-        migrations_from_db: List[Migration] = sorted(
-            get_db_migrations(conn), key=lambda m: m.migration_id
-        )
-        migrations_from_filesystem: List[Migration] = sorted(
-            parse_migrations(migrations_directory), key=lambda m: m.migration_id
-        )
+            migrations_from_db: List[Migration] = get_db_migrations(conn, table)
 
-        old_branch, new_branch = get_diff(
-            migrations_from_db,
-            migrations_from_filesystem,
-            strict_digest_check
-        )
+            old_branch, new_branch = get_diff(
+                migrations_from_db,
+                migrations_from_filesystem,
+                strict_digest_check
+            )
 
-        acquire_mutex(cursor)
+            if old_branch:
+                if auto_apply_down:
+                    unapply_all(cursor, old_branch, table)
+                else:
+                    logger.error("-a / --auto_apply_down flag is set to false")
+                    raise RuntimeError(
+                        f"failed at migration number: {old_branch[0].migration_id}"
+                    )
+            apply_all(
+                cursor,
+                complete_migrations(new_branch, migration_files, digest_cache),
+                table
+            )
+    finally:
+        if use_pool:
+            release_connection(pool, conn)
+        else:
+            conn.close()
+
+        # File digests stay valid whether or not the migrations went through
+        if digest_cache is not None:
+            digest_cache.save()
+
+
+def get_connection_pool(db_params: DBParams) -> ThreadedConnectionPool:
+    with _pools_lock:
+        if db_params not in _pools:
+            _pools[db_params] = ThreadedConnectionPool(
+                minconn=1, maxconn=4, **asdict(db_params)
+            )
+        return _pools[db_params]
+
+
+def release_connection(pool: ThreadedConnectionPool, conn) -> None:
+    try:
+        # Drops the role, search path and lock timeout set for the run
+        conn.reset()
+    except (InterfaceError, OperationalError):
+        pool.putconn(conn, close=True)
+    else:
+        pool.putconn(conn)
 
-        if old_branch:
-            if auto_apply_down:
-                unapply_all(cursor, old_branch)
-            else:
-                logger.error("-a / --auto_apply_down flag is set to false")
-                raise RuntimeError(
-                    f"failed at migration number: {old_branch[0].migration_id}"
-                )
-        apply_all(cursor, new_branch)
 
+def close_connection_pools() -> None:
+    with _pools_lock:
+        while _pools:
+            _, pool = _pools.popitem()
+            pool.closeall()
 
-def apply_all(cursor, migrations) -> None:
-    assert (
-        sorted(migrations, key=lambda m: m.migration_id) == migrations
+
+def apply_all(cursor, migrations, table: sql.Identifier) -> None:
+    assert all(
+        a.migration_id < b.migration_id for a, b in zip(migrations, migrations[1:])
     ), "Migrations must be applied in ascending order"
+
+    # One execute per migration on purpose: a failing migration raises
+    # on its own statement, so the error points at the right file. The
+    # bookkeeping for the whole batch then costs a single round trip
     for migration in migrations:
         apply_up(cursor, migration)
 
+    insert_migrations(cursor, migrations, table)
 
-def unapply_all(cursor, migrations) -> None:
+
+def insert_migrations(
+    cursor,
+    migrations: List[Migration],
+    table: sql.Identifier
+) -> None:
+    rows = [
+        (
+            migration.migration_id,
+            migration.up_digest,
+            migration.up,
+            migration.down_digest,
+            migration.down,
+        )
+        for migration in migrations
+    ]
+
+    if len(rows) >= copy_threshold:
+        # QUOTE_ALL keeps empty down migrations from being read as NULL
+        buf = io.StringIO()
+        csv.writer(buf, quoting=csv.QUOTE_ALL).writerows(rows)
+        size = buf.tell()
+        buf.seek(0)
+        # The rows are in memory already, reading them in one go sends
+        # the batch as one copy message instead of one per 8kB
+        cursor.copy_expert(
+            COPY_MIGRATIONS.format(table=table), buf, size=size
+        )
+    elif rows:
+        execute_values(
+            cursor,
+            INSERT_MIGRATIONS.format(table=table),
+            rows,
+            page_size=100,
+        )
+
+
+def unapply_all(cursor, migrations, table: sql.Identifier) -> None:
     logger.warning(f'Unapplying migrations: {migrations}')
-    assert (
-        sorted(migrations, key=lambda m: m.migration_id, reverse=True) == migrations
+    assert all(
+        a.migration_id > b.migration_id for a, b in zip(migrations, migrations[1:])
     ), "Migrations must be unapplied in descending order"
     for migration in migrations:
         apply_down(cursor, migration)
 
+    if migrations:
+        cursor.execute(
+            DELETE_MIGRATIONS.format(table=table),
+            ([migration.migration_id for migration in migrations],),
+        )
+
 
 def apply_up(cursor, migration: Migration) -> None:
 
     print_up_down(migration, "up")
 
     cursor.execute(migration.up)
-    cursor.execute(
-        f"""
-            INSERT INTO {migrations_table} (migration_id, up_digest, up, down_digest, down)
-            VALUES (%s, %s, %s, %s, %s);
-        """,
-        (
-            migration.migration_id,
-            digest(migration.up),
-            migration.up,
-            digest(migration.down),
-            migration.down,
-        ),
-    )
 
 
 def apply_down(cursor, migration: Migration) -> None:
@@ -291,9 +565,23 @@ def apply_down(cursor, migration: Migration) -> None:
     # skip empty down migrations
     if migration.down:
         cursor.execute(migration.down)
-    cursor.execute(
-        f"DELETE FROM {migrations_table}  WHERE migration_id = {migration.migration_id};"
-    )
+
+
+def table_identifier(name: str) -> sql.Identifier:
+    # A dot still separates the schema from the table
+    return sql.Identifier(*(fold_identifier(part) for part in name.split(".")))
+
+
+def fold_identifier(name: str) -> str:
+    """
+    The name the server makes of a name pasted into SQL: double quoted
+    names are kept as they are, unquoted ones only have A-Z lower-cased
+    """
+    name = name.strip()
+
+    if len(name) >= 2 and name.startswith('"') and name.endswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name.translate(ASCII_LOWER)
 
 
 def _get_migrations_directory(pathname: str) -> PosixPath:
@@ -307,27 +595,39 @@ def _get_migrations_directory(pathname: str) -> PosixPath:
         return migrations_directory
 
 
-def digest(s: str) -> str:
-    return sha256(s.encode("utf-8")).hexdigest()
+def digest(data: bytes) -> str:
+    return sha256(data).hexdigest()
+
+
+def digest_str(s: str) -> str:
+    return digest(s.encode("utf-8"))
+
 
+def digest_all(contents: List[bytes]) -> List[str]:
+    if len(contents) < min_parallel_digests:
+        return [digest(data) for data in contents]
 
-def get_db_migrations(conn) -> List[Migration]:
+    # hashlib releases the GIL while hashing larger inputs,
+    # so big migrations are hashed in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(digest, contents))
 
-    with conn.cursor() as cursor:
+
+def get_db_migrations(conn, table: sql.Identifier) -> List[Migration]:
+
+    # Server side cursor, so the saved migration bodies are streamed
+    # in pages instead of being fetched all at once
+    with conn.cursor(name="goose_migrations_stream") as cursor:
+        cursor.itersize = 256
         cursor.execute(
-            f"select migration_id, up_digest, up, down_digest, down from {migrations_table}"
+            sql.SQL("""
+                select migration_id, up_digest, up, down_digest, down
+                  from {table}
+                 order by migration_id
+            """).format(table=table)
         )
-        rs = cursor.fetchall()
-        return [
-            Migration(
-                migration_id=r[0],
-                up_digest=r[1],
-                up=r[2],
-                down_digest=r[3],
-                down=r[4]
-            )
-            for r in rs
-        ]
+        # Columns are selected in the order of the Migration fields
+        return [Migration(*r) for r in cursor]
 
 
 def get_diff(
@@ -336,77 +636,75 @@ def get_diff(
     strict_digest_check: bool
 ) -> Tuple[List[Migration], List[Migration]]:
 
-    first_divergence = None
+    # Both lists are sorted by migration_id and numbered from 1 without
+    # gaps, so equal positions hold the same migration id
+    common = min(len(db_migrations), len(file_system_migrations))
 
-    for db_migration, file_migration in zip(db_migrations, file_system_migrations):
+    i = 0
+    while i < common and not diverges(
+        db_migrations[i], file_system_migrations[i], strict_digest_check
+    ):
+        i += 1
 
-        if strict_digest_check:
-            db_digest = digest(db_migration.up)
-            file_digest = digest(file_migration.up)
-        else:
-            db_digest = db_migration.up_digest
-            file_digest = file_migration.up_digest
-
-        if db_digest != file_digest:
-            logger.info(f"\nDivergence found at: {db_migration.migration_id}")
-            logger.info(f"  DB Migration Digest: {db_digest}")
-            logger.info(f"File Migration Digest: {file_digest}")
-            first_divergence = db_migration
-            break
-
-    if first_divergence:
-        old_branch = sorted(
-            [
-                m for m in db_migrations 
-                if m.migration_id >= first_divergence.migration_id
-            ],
-            key=lambda m: m.migration_id,
-            reverse=True,
-        )
-        new_branch = sorted(
-            [
-                m for m in file_system_migrations
-                if m.migration_id >= first_divergence.migration_id
-            ],
-            key=lambda m: m.migration_id,
-        )
+    if i == common:
+        return [], file_system_migrations[len(db_migrations):]
+
+    db_migration = db_migrations[i]
 
+    if strict_digest_check:
+        db_digest = digest_str(db_migration.up)
     else:
-        old_branch = []
+        db_digest = db_migration.up_digest
 
-        if not db_migrations:
-            max_old_id = 0
-        else:
-            max_old_id = max(m.migration_id for m in db_migrations)
+    logger.info(f"\nDivergence found at: {db_migration.migration_id}")
+    logger.info(f"  DB Migration Digest: {db_digest}")
+    logger.info(f"File Migration Digest: {digest_str(file_system_migrations[i].up)}")
 
-        new_branch = sorted(
-            [m for m in file_system_migrations if m.migration_id > max_old_id],
-            key=lambda m: m.migration_id,
-        )
+    return db_migrations[i:][::-1], file_system_migrations[i:]
 
-    return old_branch, new_branch
 
+def diverges(
+    db_migration: Migration,
+    file_migration: Migration,
+    strict_digest_check: bool
+) -> bool:
+
+    if strict_digest_check:
+        # Re-computing the db digest only to compare it with the
+        # file digest is the same as comparing the saved text
+        # directly, which skips hashing the whole db side
+        return db_migration.up != file_migration.up
+
+    if file_migration.up_digest is not None:
+        return db_migration.up_digest != file_migration.up_digest
+
+    # A length mismatch means the file changed since it was saved,
+    # so the file is only hashed when the lengths agree
+    return (
+        len(db_migration.up) != len(file_migration.up)
+        or db_migration.up_digest != digest_str(file_migration.up)
+    )
 
-def CINE_migrations_table(cursor) -> None:
-    try:
-        cursor.execute(
-            f"""
-            create table if not exists {migrations_table} (
-                migration_id int      not null primary key,
-                up_digest    char(64) not null,
-                up           text     not null,
-                down_digest  char(64) not null,
-                down         text     not null,
-
-                /* meta */
-                created_datetime  timestamp not null default now(),
-                modified_datetime timestamp not null default now()
-            );
-                """
+
+def CINE_migrations_table_sql(table: sql.Identifier) -> sql.Composed:
+    return sql.SQL(
+        """
+        create table if not exists {table} (
+            migration_id int      not null primary key,
+            up_digest    char(64) not null,
+            up           text     not null,
+            down_digest  char(64) not null,
+            down         text     not null,
+
+            /* meta */
+            created_datetime  timestamp not null default now(),
+            modified_datetime timestamp not null default now()
         )
+    """
+    ).format(table=table)
 
-    except IntegrityError as e:
-        raise RuntimeError("Migrations already in process")
+
+atexit.register(close_connection_pools)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,20 @@
-from dataclasses import dataclass
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, fields
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from typing import Dict, Iterable, List, Optional
 
 from app_logger import get_app_logger
 
 logger = get_app_logger()
 
 
-@dataclass
+@dataclass(frozen=True)
 class DBParams:
+    __slots__ = ("user", "password", "host", "port", "database")
+
     user: str
     password: str
     host: str
@@ -15,33 +23,123 @@ class DBParams:
 
     def __str__(self):
         return ' '.join(
-            f'--{param}={value}' for param, value in vars(self).items()
+            f'--{param}={value}' for param, value in asdict(self).items()
         )
 
 
-@dataclass
+@dataclass(frozen=True)
 class Migration:
+    # Slotted by hand, dataclass(slots=True) needs Python 3.10
+    __slots__ = ("migration_id", "up_digest", "up", "down_digest", "down")
+
     migration_id: int
-    up_digest: str
+    up_digest: Optional[str]
     up: str
-    down_digest: str
-    down: str
+    down_digest: Optional[str]
+    down: Optional[str]
+
+
+class DigestCache:
+    """
+    Digests of migration files from earlier runs, an entry is only
+    trusted while the file's mtime and size are unchanged
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, List] = {}
+        self.changed = False
+
+        try:
+            with open(path) as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError):
+            return
+
+        if not isinstance(entries, dict):
+            return
+
+        # Malformed entries are dropped, so they only cost a cache miss
+        self.entries = {
+            name: cached
+            for name, cached in entries.items()
+            if isinstance(cached, list) and len(cached) == 3
+            and isinstance(cached[2], str)
+        }
+        self.changed = len(self.entries) != len(entries)
+
+    @classmethod
+    def for_directory(cls, dir) -> "DigestCache":
+        cache_home = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        name = sha256(os.fsencode(dir)).hexdigest()
+        return cls(os.path.join(cache_home, "postgoose", f"{name}.json"))
+
+    def get(self, entry: os.DirEntry) -> Optional[str]:
+        stat = entry.stat()
+        cached = self.entries.get(entry.name)
+
+        if cached and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return cached[2]
+        return None
+
+    def prune(self, names: Iterable[str]) -> None:
+        """
+        Forgets the digests of files that are no longer there
+        """
+        names = set(names)
+        stale = [name for name in self.entries if name not in names]
+
+        for name in stale:
+            del self.entries[name]
+        if stale:
+            self.changed = True
+
+    def put(self, entry: os.DirEntry, digest: str) -> None:
+        stat = entry.stat()
+        self.entries[entry.name] = [stat.st_mtime_ns, stat.st_size, digest]
+        self.changed = True
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+
+        cache_dir = os.path.dirname(self.path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # Written next to the cache and renamed over it, so concurrent
+            # runs never read a half written cache
+            with NamedTemporaryFile("w", dir=cache_dir, delete=False) as fp:
+                json.dump(self.entries, fp)
+            try:
+                os.replace(fp.name, self.path)
+            except OSError:
+                os.unlink(fp.name)
+                raise
+        except OSError as e:
+            logger.warning(f"Could not save digest cache {self.path}: {e}")
+            return
+
+        self.changed = False
 
 
 def print_args(args_object):
 
     args_dict = vars(args_object)
 
-    print("\nArguments: ")
-    for key, value in args_dict.items():
-        print(f"   {key:>22} : {value}")
+    print(
+        "\nArguments: \n"
+        + "\n".join(f"   {key:>22} : {value}" for key, value in args_dict.items())
+    )
 
 
-def print_up_down(migration, migration_type) -> None:
+def print_up_down(migration: Migration, migration_type: str) -> None:
 
-    logger.info(f"\nMigration ID: {getattr(migration, 'migration_id')}")
+    logger.info(f"\nMigration ID: {migration.migration_id}")
     logger.info(f"Migration Type: {migration_type}")
 
-    logger.debug(f"Migrations:\n")
-    for key, value in vars(migration).items():
-        logger.debug(f'{key}={value}')
+    # Skips formatting whole migration bodies unless they are logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Migrations:\n")
+        for field in fields(migration):
+            logger.debug(f'{field.name}={getattr(migration, field.name)}')
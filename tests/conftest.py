@@ -19,3 +19,11 @@ def auto_apply_down(request):
 @pytest.fixture
 def strict_digest_check(request):
     return not request.config.getoption('--no_strict_digest_check')
+
+
+@pytest.fixture(autouse=True)
+def digest_cache_home(tmp_path_factory, monkeypatch):
+    """Keep the digest cache of test runs out of the user's cache"""
+    cache_home = tmp_path_factory.mktemp('cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(cache_home))
+    return cache_home
@@ -1,9 +1,14 @@
+import json
 import os
+from hashlib import sha256
 
 import pytest
 from pytest_postgresql import factories
 
-from goose import run_migrations, DBParams
+import goose
+from goose import (
+    close_connection_pools, get_connection_pool, run_migrations, DBParams, DigestCache
+)
 
 postgresql_in_docker = factories.postgresql_noproc(dbname='pytest_db')
 postgresql = factories.postgresql("postgresql_in_docker", dbname='pytest_db')
@@ -21,6 +26,21 @@ def db_params(postgresql):
     return db_params
 
 
+@pytest.fixture
+def small_migrations(tmp_path):
+    """Two quick migrations, for tests about how migrations are run"""
+    migrations_directory = tmp_path / 'small_migrations'
+    migrations_directory.mkdir()
+
+    (migrations_directory / '1_up.sql').write_text(
+        "create table xs (x text);\ninsert into xs values ('a');"
+    )
+    (migrations_directory / '1_down.sql').write_text('drop table xs;')
+    (migrations_directory / '2_up.sql').write_text("insert into xs values ('b');")
+    (migrations_directory / '2_down.sql').write_text("delete from xs where x = 'b';")
+    return migrations_directory
+
+
 def test_xs_migrations(
     db_params,
     auto_apply_down,
@@ -109,3 +129,438 @@ def test_cmd_migrations(
             (6, 'c'),
             (7, 'd')
         ]
+
+
+def test_bulk_migrations(
+    db_params,
+    verbose,
+    strict_digest_check,
+    postgresql,
+    tmp_path
+):
+    """Enough migrations to record them with COPY instead of INSERT"""
+
+    migrations_directory = tmp_path / 'bulk_migrations'
+    migrations_directory.mkdir()
+
+    (migrations_directory / '1_up.sql').write_text(
+        'create table zs (\n  z text not null\n);'
+    )
+    (migrations_directory / '1_down.sql').write_text('')
+    for migration_id in range(2, 21):
+        (migrations_directory / f'{migration_id}_up.sql').write_text(
+            f"insert into zs values ('{migration_id}, \"quoted\" \\\\ ''x''');\n"
+        )
+        (migrations_directory / f'{migration_id}_down.sql').write_text(
+            f"delete from zs where z like '{migration_id},%';"
+        )
+
+    # The second run must find the recorded migrations in sync
+    for _ in range(2):
+        run_migrations(
+            migrations_directory,
+            db_params,
+            verbose=verbose,
+            strict_digest_check=strict_digest_check
+        )
+
+    with postgresql.cursor() as cur:
+        cur.execute('SELECT count(*) FROM zs;')
+        assert cur.fetchone() == (19,)
+
+        cur.execute(
+            'SELECT migration_id, up, down FROM goose_migrations ORDER BY migration_id;'
+        )
+        assert cur.fetchall() == [
+            (
+                migration_id,
+                (migrations_directory / f'{migration_id}_up.sql').read_text(),
+                (migrations_directory / f'{migration_id}_down.sql').read_text(),
+            )
+            for migration_id in range(1, 21)
+        ]
+
+
+def test_cached_digests(
+    db_params,
+    verbose,
+    postgresql,
+    tmp_path,
+    digest_cache_home,
+    monkeypatch
+):
+    """Cached digests are reused, but must not hide a changed migration"""
+
+    migrations_directory = tmp_path / 'cached_migrations'
+    migrations_directory.mkdir()
+
+    (migrations_directory / '1_up.sql').write_text('create table ws (w text);')
+    (migrations_directory / '1_down.sql').write_text('drop table ws;')
+    (migrations_directory / '2_up.sql').write_text("insert into ws values ('a');")
+    (migrations_directory / '2_down.sql').write_text('delete from ws;')
+
+    # Only the non strict check compares digests instead of the text
+    run_migrations(
+        migrations_directory,
+        db_params,
+        verbose=verbose,
+        strict_digest_check=False
+    )
+    assert list((digest_cache_home / 'postgoose').iterdir())
+
+    def no_digest(data):
+        raise AssertionError('digest computed despite the cache')
+
+    with monkeypatch.context() as m:
+        m.setattr(goose, 'digest', no_digest)
+        run_migrations(
+            migrations_directory,
+            db_params,
+            verbose=verbose,
+            strict_digest_check=False
+        )
+
+    # Same size, so only the mtime tells the cache that the file changed
+    up_file = migrations_directory / '2_up.sql'
+    stat = up_file.stat()
+    up_file.write_text("insert into ws values ('b');")
+    os.utime(up_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    run_migrations(
+        migrations_directory,
+        db_params,
+        auto_apply_down=True,
+        verbose=verbose,
+        strict_digest_check=False
+    )
+
+    with postgresql.cursor() as cur:
+        cur.execute('SELECT * FROM ws;')
+        assert cur.fetchall() == [('b',)]
+
+
+def test_strict_check_without_digests(
+    db_params,
+    verbose,
+    postgresql,
+    small_migrations,
+    digest_cache_home,
+    monkeypatch
+):
+    """The strict check compares text, even a cold cache must not hash"""
+
+    run_migrations(small_migrations, db_params, verbose=verbose)
+    assert list((digest_cache_home / 'postgoose').iterdir())
+
+    for cache_file in (digest_cache_home / 'postgoose').iterdir():
+        cache_file.unlink()
+
+    def no_digest(data):
+        raise AssertionError('digest computed for the strict check')
+
+    monkeypatch.setattr(goose, 'digest', no_digest)
+    run_migrations(small_migrations, db_params, verbose=verbose)
+
+    # Digests of the applied migrations are still recorded
+    with postgresql.cursor() as cur:
+        cur.execute('SELECT up_digest, up FROM goose_migrations;')
+        for up_digest, up in cur.fetchall():
+            assert up_digest == sha256(up.encode('utf-8')).hexdigest()
+
+
+def test_digest_cache_edit_during_read(
+    db_params,
+    verbose,
+    postgresql,
+    tmp_path,
+    monkeypatch
+):
+    """A file saved while the run reads it must not be cached as unchanged"""
+
+    migrations_directory = tmp_path / 'edited_migrations'
+    migrations_directory.mkdir()
+
+    (migrations_directory / '1_up.sql').write_text('create table ws (w text);')
+    (migrations_directory / '1_down.sql').write_text('drop table ws;')
+    up_file = migrations_directory / '2_up.sql'
+    up_file.write_text("insert into ws values ('a');")
+    (migrations_directory / '2_down.sql').write_text('delete from ws;')
+
+    read_migration_file = goose.read_migration_file
+
+    def read_then_save(path):
+        data = read_migration_file(path)
+        if path == str(up_file):
+            stat = up_file.stat()
+            up_file.write_text("insert into ws values ('b');")
+            os.utime(up_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        return data
+
+    with monkeypatch.context() as m:
+        m.setattr(goose, 'read_migration_file', read_then_save)
+        run_migrations(
+            migrations_directory,
+            db_params,
+            verbose=verbose,
+            strict_digest_check=False
+        )
+
+    run_migrations(
+        migrations_directory,
+        db_params,
+        auto_apply_down=True,
+        verbose=verbose,
+        strict_digest_check=False
+    )
+
+    with postgresql.cursor() as cur:
+        cur.execute('SELECT * FROM ws;')
+        assert cur.fetchall() == [('b',)]
+
+
+def test_empty_migrations(db_params, verbose, postgresql, tmp_path):
+    """An empty migrations folder must leave the database alone"""
+
+    run_migrations(tmp_path, db_params, verbose=verbose)
+
+    with postgresql.cursor() as cur:
+        cur.execute("SELECT to_regclass('goose_migrations');")
+        assert cur.fetchone() == (None,)
+
+
+def test_malformed_digest_cache(tmp_path):
+    """Unusable cache entries are misses, entries of removed files go away"""
+
+    (tmp_path / '1_up.sql').write_text('select 1;')
+    cache_path = tmp_path / 'cache.json'
+    cache_path.write_text(json.dumps({
+        '1_up.sql': {'digest': 'x'},
+        '2_up.sql': 5,
+        '3_up.sql': [1, 2, 'x'],
+    }))
+
+    digest_cache = DigestCache(str(cache_path))
+    with os.scandir(tmp_path) as entries:
+        up_file = next(entry for entry in entries if entry.name == '1_up.sql')
+    assert digest_cache.get(up_file) is None
+
+    digest_cache.prune(['1_up.sql'])
+    digest_cache.save()
+    assert json.loads(cache_path.read_text()) == {}
+
+
+def test_pooled_migrations(
+    db_params,
+    verbose,
+    strict_digest_check,
+    postgresql,
+    small_migrations
+):
+    """Runs sharing a pooled connection must not see each others session"""
+
+    with postgresql.cursor() as cur:
+        cur.execute('CREATE SCHEMA pooled;')
+    postgresql.commit()
+
+    try:
+        run_migrations(
+            small_migrations,
+            db_params,
+            schema='pooled',
+            verbose=verbose,
+            strict_digest_check=strict_digest_check,
+            use_pool=True
+        )
+
+        # The connection the run gave back, as the next run gets it
+        pool = get_connection_pool(db_params)
+        conn = pool.getconn()
+        with conn.cursor() as cur:
+            cur.execute('SHOW search_path;')
+            assert cur.fetchone() == ('"$user", public',)
+            cur.execute('SHOW lock_timeout;')
+            assert cur.fetchone() == ('0',)
+        pool.putconn(conn)
+
+        run_migrations(
+            small_migrations,
+            db_params,
+            verbose=verbose,
+            strict_digest_check=strict_digest_check,
+            use_pool=True
+        )
+    finally:
+        close_connection_pools()
+
+    with postgresql.cursor() as cur:
+        cur.execute('SELECT * FROM pooled.xs;')
+        assert cur.fetchall() == [('a',), ('b',)]
+        cur.execute('SELECT * FROM public.xs;')
+        assert cur.fetchall() == [('a',), ('b',)]
+
+
+def test_custom_migrations_table(
+    db_params,
+    verbose,
+    strict_digest_check,
+    postgresql,
+    small_migrations
+):
+    """Unquoted table names fold to lower case and may name a schema"""
+
+    for migrations_table_name in ('public.Custom_Migrations', 'custom_migrations'):
+        run_migrations(
+            small_migrations,
+            db_params,
+            migrations_table_name=migrations_table_name,
+            verbose=verbose,
+            strict_digest_check=strict_digest_check
+        )
+
+    with postgresql.cursor() as cur:
+        cur.execute('SELECT count(*) FROM public.custom_migrations;')
+        assert cur.fetchone() == (2,)
+        cur.execute("SELECT to_regclass('goose_migrations');")
+        assert cur.fetchone() == (None,)
+
+
+def test_quoted_schema_and_role(
+    db_params,
+    verbose,
+    strict_digest_check,
+    postgresql,
+    small_migrations
+):
+    """Quoted schema and role names keep their case"""
+
+    with postgresql.cursor() as cur:
+        cur.execute('CREATE ROLE "AppOwner";')
+        cur.execute('CREATE SCHEMA "MySchema" AUTHORIZATION "AppOwner";')
+    postgresql.commit()
+
+    try:
+        run_migrations(
+            small_migrations,
+            db_params,
+            schema='"MySchema", public',
+            role='"AppOwner"',
+            verbose=verbose,
+            strict_digest_check=strict_digest_check
+        )
+
+        with postgresql.cursor() as cur:
+            cur.execute(
+                "SELECT tableowner FROM pg_tables WHERE schemaname = 'MySchema'"
+                " ORDER BY tablename;"
+            )
+            assert cur.fetchall() == [('AppOwner',), ('AppOwner',)]
+    finally:
+        # Roles outlive the test database
+        with postgresql.cursor() as cur:
+            cur.execute('DROP OWNED BY "AppOwner";')
+            cur.execute('DROP ROLE "AppOwner";')
+        postgresql.commit()
+
+
+def test_quoted_migrations_table(
+    db_params,
+    verbose,
+    strict_digest_check,
+    postgresql,
+    small_migrations
+):
+    """Quoted table names keep their case, as they did pasted into the SQL"""
+
+    with postgresql.cursor() as cur:
+        cur.execute('CREATE SCHEMA "GooseSchema";')
+    postgresql.commit()
+
+    # The second run must find the migrations recorded by the first
+    for _ in range(2):
+        run_migrations(
+            small_migrations,
+            db_params,
+            migrations_table_name='"GooseSchema"."GooseLog"',
+            verbose=verbose,
+            strict_digest_check=strict_digest_check
+        )
+
+    with postgresql.cursor() as cur:
+        cur.execute('SELECT count(*) FROM "GooseSchema"."GooseLog";')
+        assert cur.fetchone() == (2,)
+        cur.execute('SELECT * FROM xs;')
+        assert cur.fetchall() == [('a',), ('b',)]
+
+
+def test_concurrent_migrations(db_params, verbose, postgresql, small_migrations):
+    """A run must give up while another one holds the migrations table"""
+
+    run_migrations(small_migrations, db_params, verbose=verbose)
+
+    with postgresql.cursor() as cur:
+        cur.execute('LOCK TABLE goose_migrations IN EXCLUSIVE MODE;')
+
+        with pytest.raises(RuntimeError, match='already in progress'):
+            run_migrations(small_migrations, db_params, verbose=verbose)
+
+    postgresql.rollback()
+
+
+def test_schema_migrations(
+    db_params,
+    verbose,
+    strict_digest_check,
+    postgresql,
+    small_migrations
+):
+    """Schema names fold to lower case and may list several schemas"""
+
+    with postgresql.cursor() as cur:
+        cur.execute('CREATE SCHEMA schema_1;')
+    postgresql.commit()
+
+    run_migrations(
+        small_migrations,
+        db_params,
+        schema='Schema_1, public',
+        verbose=verbose,
+        strict_digest_check=strict_digest_check
+    )
+
+    with postgresql.cursor() as cur:
+        cur.execute('SELECT count(*) FROM schema_1.goose_migrations;')
+        assert cur.fetchone() == (2,)
+        cur.execute('SELECT * FROM schema_1.xs;')
+        assert cur.fetchall() == [('a',), ('b',)]
+
+
+def check_files(directory, file_names):
+    for file_name in file_names:
+        (directory / file_name).write_text('')
+    return goose.check_migration_files(goose.get_migration_files(directory))
+
+
+def test_complete_migration_files(tmp_path):
+    files = ['1_up.sql', '1_down.sql', '2_up.sql', '2_down.sql']
+    assert check_files(tmp_path, files) == 2
+
+
+@pytest.mark.parametrize('file_names, message', [
+    (['1_up.sql', '1_down.sql', '3_up.sql', '3_down.sql'], 'Migration 2 missing ups'),
+    (['1_up.sql', '1_down.sql', '2_up.sql'], 'Migration 2 missing downs'),
+    (['1_up.sql', '1_down.sql', '2_down.sql'], 'Migration 2 missing ups'),
+    (['2_up.sql', '2_down.sql'], 'Migration 1 missing ups'),
+    (['1_up.sql', '2_up.sql', '2_down.sql'], 'Migration 1 missing downs'),
+    (['1_up.sql', '1_down.sql', '1000_up.sql'], 'Migration 2 missing ups'),
+    (['1000_up.sql', '1000_down.sql'], 'Migration 1 missing ups'),
+])
+def test_missing_migration_files(tmp_path, file_names, message):
+    with pytest.raises(AssertionError, match=f'^{message}$'):
+        check_files(tmp_path, file_names)
+
+
+@pytest.mark.parametrize('extra_file', ['foo.sql', '01_up.sql', '1_UP.SQL'])
+def test_extra_migration_files(tmp_path, extra_file):
+    with pytest.raises(SystemExit) as exit_info:
+        check_files(tmp_path, ['1_up.sql', '1_down.sql', extra_file])
+    assert exit_info.value.code == 3